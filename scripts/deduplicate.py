@@ -1,307 +1,684 @@
 import argparse
 import logging
+import multiprocessing
 import os
+import queue
 import sys
-import time
-import base64
-import json
 import re
-from typing import Optional, List, Dict, Any, Union
-from urllib.parse import urlparse, parse_qs, unquote
-from hashlib import sha256 # اطمینان از ایمپورت شدن
+import string
+from functools import lru_cache
+from operator import itemgetter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, List, Dict, Any, Iterable, Iterator, Tuple, Union
+from urllib.parse import urlsplit, parse_qs, unquote, unquote_plus, SplitResult
 
 import requests
 import yaml
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from base64 import b64decode
+
+try:
+    from pybase64 import b64decode as fast_b64decode  # SIMD-accelerated
+except ImportError:
+    fast_b64decode = b64decode
+
+try:
+    from orjson import loads as json_loads  # accepts bytes, parses without a str copy
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+def configure_logging() -> QueueListener:
+    """Routes log records through a queue so console writes happen on a background thread."""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+# Worker processes buffer their records here; dedupe_in_worker returns them
+# with each result so the parent logs them under the right URL header.
+WORKER_LOG_QUEUE = queue.SimpleQueue()
+
+def configure_worker_logging() -> None:
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(WORKER_LOG_QUEUE)]
+    root.setLevel(logging.INFO)
 
 # --- توابع دانلود و دیکود ---
-def download_url(url: str, retries: int = 3, timeout: int = 10) -> Optional[str]:
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    for attempt in range(retries):
-        try:
-            response = requests.get(url, timeout=timeout, headers=headers)
-            response.raise_for_status()
-            return response.text
-        except requests.exceptions.RequestException as e:
-            logging.warning(f"Attempt {attempt + 1} failed for {url}: {e}")
-            time.sleep(2)
-    logging.error(f"Failed to download {url} after {retries} attempts.")
-    return None
+MAX_DOWNLOAD_WORKERS = 32
+# Connection errors, timeouts and transient server statuses are retried by
+# urllib3 with exponential backoff; other HTTP errors fail immediately.
+# Retry-After is ignored: it has no upper bound, and results are consumed in
+# input order, so one server asking for a long wait would stall every URL.
+DOWNLOAD_RETRY = Retry(
+    total=3, backoff_factor=2, status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=False,
+)
+
+def mount_pooled_adapters(session: requests.Session, pool_size: int) -> None:
+    """Sizes the session's connection pools to match the number of download workers."""
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=DOWNLOAD_RETRY))
+
+# Shared session so TCP/TLS connections are reused across URLs and retries.
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+mount_pooled_adapters(SESSION, MAX_DOWNLOAD_WORKERS)
+
+def download_url(url: str, timeout: int = 10) -> Optional[str]:
+    try:
+        response = SESSION.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.text
+    except requests.exceptions.RequestException as e:
+        logging.error("Failed to download %s: %s", url, e)
+        return None
+
+def download_in_order(urls: Iterable[str], workers: int) -> Iterator[Tuple[str, Optional[str]]]:
+    """Downloads URLs on a thread pool and yields ``(url, content)`` in input order.
+
+    At most ``2 * workers`` downloads are in flight, so the input is consumed
+    lazily instead of being queued all at once.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for url in urls:
+            pending.append((url, executor.submit(download_url, url)))
+            if len(pending) >= 2 * workers:
+                done_url, future = pending.popleft()
+                yield done_url, future.result()
+        while pending:
+            done_url, future = pending.popleft()
+            yield done_url, future.result()
+
+# Links mix the standard and URL-safe alphabets; mapping to the standard one
+# keeps '+'/'/' valid, which the urlsafe decoders are deprecating.
+URLSAFE_TO_STANDARD = str.maketrans('-_', '+/')
+
+# Only padding and line endings may follow the data for pybase64 to be used.
+TRAILING_PADDING = '=\r\n \t'
 
 def safe_b64decode(s: str) -> bytes:
-    s = s.replace('-', '+').replace('_', '/')
-    padding = len(s) % 4
-    if padding != 0:
-        s += '=' * (4 - padding)
-    return base64.b64decode(s)
-
-def decode_content(content: str) -> List[str]:
-    lines = []
-    try:
-        decoded_bytes = safe_b64decode(content)
-        decoded_str = decoded_bytes.decode('utf-8', errors='ignore')
-        lines = decoded_str.splitlines()
-        logging.info("  Content decoded as Base64.")
-    except Exception:
+    s = s.translate(URLSAFE_TO_STANDARD)
+    s += '=' * (-len(s) & 3)
+    # The stdlib decoder stops at the '=' that closes a block, while pybase64
+    # keeps decoding what follows ('...==#remark', concatenated blocks). Both
+    # agree when padding only appears at the end.
+    if '=' in s.rstrip(TRAILING_PADDING):
+        return b64decode(s)
+    return fast_b64decode(s)
+
+# Whitespace is allowed: the decoder skips it, and some bodies are wrapped or indented.
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/-_=\r\n \t'
+BASE64_SAMPLE_SIZE = 256
+
+def looks_like_base64(content: str) -> bool:
+    """Checks whether the start of the content uses only Base64 characters.
+
+    The non-validating decoder silently skips foreign characters, so plain-text
+    subscriptions (``vless://...``) would otherwise "decode" into garbage.
+    """
+    sample = content.lstrip()[:BASE64_SAMPLE_SIZE]
+    return sample.isascii() and not sample.encode('ascii').translate(None, BASE64_ALPHABET)
+
+def decode_content(content: str) -> Iterator[str]:
+    """Yields the stripped, non-empty lines of a Base64 or plain-text subscription."""
+    lines = None
+    if looks_like_base64(content):
+        try:
+            decoded_bytes = safe_b64decode(content)
+            decoded_str = decoded_bytes.decode('utf-8', errors='ignore')
+            lines = decoded_str.splitlines()
+            logging.info("  Content decoded as Base64.")
+        except ValueError:
+            pass
+    if lines is None:
         lines = content.splitlines()
         logging.info("  Content treated as plain text.")
-    return [line.strip() for line in lines if line.strip()]
+    return (stripped for stripped in (line.strip() for line in lines) if stripped)
 
 # --- پارسر پیشرفته ---
-def parse_proxy_link(link: str) -> Optional[Dict[str, Any]]:
+# Everything before the first '@' or '#' is the (possibly base64) SS user info;
+# legacy links without '@' carry only a '#remark' after it. An SSR link is
+# base64 in its entirety. A failed match raises inside the branch.
+BASE64_TEXT_RE = re.compile(r'[A-Za-z0-9+/=_-]+')
+SS_USERINFO_RE = re.compile(r'ss://([^@#]*)')
+SSR_BODY_RE = re.compile(r'ssr://(.*)', re.DOTALL)
+SSR_DECODED_RE = re.compile(r'([^:]*):([^:]*):([^:]*):([^:]*):([^:]*):([^:]*?)/\?(.*)\Z', re.DOTALL)
+SCHEME_CHARS = frozenset(string.ascii_letters + string.digits + '+-.')
+
+def fast_split(link: str) -> Optional[SplitResult]:
+    """Splits a plain ``scheme://netloc/path?query#fragment`` link with str.partition.
+
+    Returns None for links that need urlsplit's full handling (non-ASCII,
+    embedded tabs/newlines, IPv6 literals, no ``://``). The result is a regular
+    SplitResult, so username/hostname/port behave exactly as with urlsplit.
+    """
+    if not link.isascii() or '\t' in link or '\r' in link or '\n' in link:
+        return None
+    scheme, sep, rest = link.partition('://')
+    if not sep or not scheme[:1].isalpha() or not SCHEME_CHARS.issuperset(scheme):
+        return None
+    # The netloc can contain none of '#', '?' or '/', so the first of each
+    # in the remainder delimits fragment, query and path as urlsplit does.
+    rest, _, fragment = rest.partition('#')
+    rest, _, query = rest.partition('?')
+    netloc, slash, path = rest.partition('/')
+    if '[' in netloc or ']' in netloc:
+        return None
+    return SplitResult(scheme.lower(), netloc, slash + path, query, fragment)
+
+# Subscriptions repeat the same '?type=ws&security=tls&...' across many links.
+@lru_cache(maxsize=4096)
+def parse_query(query: str) -> Dict[str, str]:
+    """Equivalent of ``{k.lower(): v[0] for k, v in parse_qs(query).items()}``.
+
+    The result is cached and shared between calls, so callers must not mutate it.
+    """
+    first_values = {}
+    for name_value in query.split('&'):
+        name, has_value, value = name_value.partition('=')
+        # parse_qs drops pairs without '=' and pairs with blank values.
+        if has_value and value:
+            first_values.setdefault(unquote_plus(name), unquote_plus(value))
+    return {k.lower(): v for k, v in first_values.items()}
+
+# Scheme handlers take the split link, the raw link, the config seeded with
+# protocol and query params, and the query params; they return the config
+# (or a replacement) or None when the link cannot be parsed.
+def _parse_vless_trojan(p: SplitResult, link: str, config: Dict[str, Any], query_params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    config['server'] = p.hostname
+    config['port'] = p.port
+    config['uuid' if p.scheme == 'vless' else 'password'] = p.username
+    return config
+
+def _parse_vmess(p: SplitResult, link: str, config: Dict[str, Any], query_params: Dict[str, str]) -> Optional[Dict[str, Any]]:
     try:
-        p = urlparse(link)
-        config = {'protocol': p.scheme, 'remarks': unquote(p.fragment)}
-        query_params = {k.lower(): v[0] for k, v in parse_qs(p.query).items()}
-        config.update(query_params)
-
-        if p.scheme == 'vless' or p.scheme == 'trojan':
-            config['server'] = p.hostname
-            config['port'] = p.port
-            if p.scheme == 'vless': config['uuid'] = p.username
-            elif p.scheme == 'trojan': config['password'] = p.username
+        # A '#remark' appended to the payload is not Base64; drop it before decoding.
+        # Both JSON backends accept the decoded bytes directly.
+        vmess_data = json_loads(safe_b64decode(link[8:].partition('#')[0]))
+        get = vmess_data.get
+        return {
+            'protocol': 'vmess',
+            'remarks': get('ps', ''),
+            'server': get('add', ''),
+            'port': int(get('port', 0)),
+            'uuid': get('id', ''),
+            'alterId': get('aid', '0'),
+            'security': get('scy', get('security', 'auto')),
+            'type': get('net', 'tcp'),
+            'host': get('host', ''),
+            'path': get('path', ''),
+            'tls': get('tls', 'none'),
+            'sni': get('sni', get('host', '')),
+        }
+    except Exception as e:
+        logging.warning("  Failed to parse VMESS JSON: %s... (%s)", link[:50], e)
+        return None
 
-        elif p.scheme == 'vmess':
-            try:
-                vmess_json_str = safe_b64decode(link[8:]).decode('utf-8')
-                vmess_data = json.loads(vmess_json_str)
-                config = {
-                    'protocol': 'vmess',
-                    'remarks': vmess_data.get('ps', ''),
-                    'server': vmess_data.get('add', ''),
-                    'port': int(vmess_data.get('port', 0)),
-                    'uuid': vmess_data.get('id', ''),
-                    'alterId': vmess_data.get('aid', '0'),
-                    'security': vmess_data.get('scy', vmess_data.get('security', 'auto')),
-                    'type': vmess_data.get('net', 'tcp'),
-                    'host': vmess_data.get('host', ''),
-                    'path': vmess_data.get('path', ''),
-                    'tls': vmess_data.get('tls', 'none'),
-                    'sni': vmess_data.get('sni', vmess_data.get('host', '')),
-                }
-            except Exception as e:
-                logging.warning(f"  Failed to parse VMESS JSON: {link[:50]}... ({e})")
-                return None
-
-        elif p.scheme == 'ss':
-            config['server'] = p.hostname
-            config['port'] = p.port
+def _parse_ss(p: SplitResult, link: str, config: Dict[str, Any], query_params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    config['server'] = p.hostname
+    config['port'] = p.port
+    try:
+        user_info_part = SS_USERINFO_RE.match(link).group(1)
+        user_info = unquote(user_info_part)
+        # Plain 'method:password' can never be Base64 (':' is outside the
+        # alphabet), so only candidates that look like Base64 are decoded.
+        if BASE64_TEXT_RE.fullmatch(user_info):
             try:
-                user_info_part = link.split('ss://')[1].split('@')[0]
-                user_info = ""
-                try: # Try Base64 first
-                    user_info = safe_b64decode(unquote(user_info_part)).decode('utf-8')
-                except: # If not Base64, assume plain text
-                    user_info = unquote(user_info_part)
-
-                if ':' in user_info:
-                    config['method'], config['password'] = user_info.split(':', 1)
-                else: # Handle cases where only method or password might be b64
-                    logging.warning(f"  Could not determine SS method/password: {user_info_part}")
-                    return None
-            except Exception as e:
-                 logging.warning(f"  Failed to parse SS link: {link[:50]}... ({e})")
-                 return None
-
-        elif p.scheme == 'ssr':
-             try:
-                 b64_part = link.split('ssr://')[1]
-                 decoded = safe_b64decode(b64_part).decode('utf-8')
-                 main_part, params_part = decoded.split('/?', 1) # Split only once
-                 s, pt, pr, m, o, pw_b64 = main_part.split(':')
-                 config.update({
-                     'server': s, 'port': int(pt), 'protocol_ssr': pr,
-                     'method': m, 'obfs': o,
-                     'password': safe_b64decode(pw_b64).decode('utf-8')
-                 })
-                 params = parse_qs(params_part)
-                 for k, v in params.items():
-                     config[k] = safe_b64decode(v[0]).decode('utf-8')
-                 config['protocol'] = 'ssr' # Set main protocol key
-             except Exception as e:
-                 logging.warning(f"  Failed to parse SSR link: {link[:50]}... ({e})")
-                 return None
-
-        elif p.scheme == 'hy2' or p.scheme == 'tuic':
-            config['password'] = p.username
-            config['server'] = p.hostname
-            config['port'] = p.port
-            config.setdefault('sni', query_params.get('sni', p.hostname))
+                user_info = safe_b64decode(user_info).decode('utf-8')
+            except ValueError: # binascii.Error/UnicodeDecodeError: not Base64 after all
+                pass
+
+        if ':' in user_info:
+            config['method'], _, config['password'] = user_info.partition(':')
+        else: # Handle cases where only method or password might be b64
+            logging.warning("  Could not determine SS method/password: %s", user_info_part)
+            return None
+    except Exception as e:
+        logging.warning("  Failed to parse SS link: %s... (%s)", link[:50], e)
+        return None
+    return config
 
-        else:
-            logging.warning(f"  Unsupported protocol scheme: {p.scheme}")
+def _parse_ssr(p: SplitResult, link: str, config: Dict[str, Any], query_params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    try:
+        b64_part = SSR_BODY_RE.match(link).group(1)
+        decoded = safe_b64decode(b64_part).decode('utf-8')
+        # host:port:protocol:method:obfs:base64(password)/?params
+        s, pt, pr, m, o, pw_b64, params_part = SSR_DECODED_RE.match(decoded).groups()
+        config.update({
+            'server': s, 'port': int(pt), 'protocol_ssr': pr,
+            'method': m, 'obfs': o,
+            'password': safe_b64decode(pw_b64).decode('utf-8')
+        })
+        params = parse_qs(params_part)
+        for k, v in params.items():
+            config[k] = safe_b64decode(v[0]).decode('utf-8')
+        config['protocol'] = 'ssr' # Set main protocol key
+    except Exception as e:
+        logging.warning("  Failed to parse SSR link: %s... (%s)", link[:50], e)
+        return None
+    return config
+
+def _parse_hy2_tuic(p: SplitResult, link: str, config: Dict[str, Any], query_params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    config['password'] = p.username
+    config['server'] = p.hostname
+    config['port'] = p.port
+    config.setdefault('sni', query_params.get('sni', p.hostname))
+    return config
+
+# One dict lookup per link instead of an if/elif ladder; new protocols only need an entry here.
+SCHEME_HANDLERS = {
+    'vless': _parse_vless_trojan,
+    'trojan': _parse_vless_trojan,
+    'vmess': _parse_vmess,
+    'ss': _parse_ss,
+    'ssr': _parse_ssr,
+    'hy2': _parse_hy2_tuic,
+    'tuic': _parse_hy2_tuic,
+}
+
+def parse_proxy_link(link: str) -> Optional[Dict[str, Any]]:
+    try:
+        # Proxy links never use ';params', so urlsplit is all that is needed.
+        p = fast_split(link) or urlsplit(link)
+        # Reject unsupported schemes before decoding the query.
+        handler = SCHEME_HANDLERS.get(p.scheme)
+        if handler is None:
+            logging.warning("  Unsupported protocol scheme: %s", p.scheme)
+            return None
+        # The fragment is only the remark, which dedup ignores and output never
+        # re-renders (raw lines are written), so it is not unquoted at all.
+        config = {'protocol': p.scheme}
+        query_params = parse_query(p.query)
+        config.update(query_params)
+        config = handler(p, link, config, query_params)
+        if config is None:
             return None
 
         if 'port' in config and config['port']:
             try: config['port'] = int(config['port'])
-            except: logging.warning(f"  Invalid port in {link}"); return None
+            except: logging.warning("  Invalid port in %s", link); return None
         return config
 
     except Exception as e:
-        logging.warning(f"  Generic parsing error for {link}: {e}")
+        logging.warning("  Generic parsing error for %s: %s", link, e)
         return None
 
 # --- توابع نرمال‌سازی و انگشت‌نگاری کامل ---
-NON_DETERMINISTIC_FIELDS = ['timestamp', 'comment', 'remarks', 'fragment', 'ps', 'add_time', 'sub', 'tag', 'group']
-UUID_FIELDS = ['id', 'uuid']
+NON_DETERMINISTIC_FIELDS = frozenset(('timestamp', 'comment', 'remarks', 'fragment', 'ps', 'add_time', 'sub', 'tag', 'group'))
 
 def load_defaults(defaults_path: str) -> Dict[str, Any]:
     try:
         with open(defaults_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
+            # An empty file loads as None; there is nothing to sort then.
+            data = yaml.load(f, Loader=YamlLoader)
+            if not data:
+                return {}
+            # Sorted once here so merged defaults never need a nested re-sort.
+            return sort_dict_keys(data)
     except FileNotFoundError:
-        logging.warning(f"Defaults file {defaults_path} not found. Continuing without defaults.")
+        logging.warning("Defaults file %s not found. Continuing without defaults.", defaults_path)
         return {}
 
+# Canonical 8-4-4-4-12 UUIDs, optionally braced or without hyphens.
+UUID_RE = re.compile(
+    r'\A\{?[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}\}?\Z',
+    re.IGNORECASE,
+)
+
+UUID_MIN_LEN, UUID_MAX_LEN = 32, 38
+
+def is_uuid(value: str) -> bool:
+    # Length gate first: most values (hosts, 'ws', 'tls', ...) never reach the regex.
+    return UUID_MIN_LEN <= len(value) <= UUID_MAX_LEN and UUID_RE.match(value) is not None
+
+def _rebuild_sorted(data: Any, clean: bool) -> Any:
+    """Copies nested dicts/lists with sorted keys using an explicit work stack.
+
+    With ``clean`` set, dict keys are lowercased, non-deterministic and empty
+    entries are dropped, and UUID strings are lowercased in the same pass.
+    """
+    if not isinstance(data, (dict, list)):
+        # Only lowercase UUIDs if they are actual UUIDs
+        return data.lower() if clean and isinstance(data, str) and is_uuid(data) else data
+
+    root = [data]
+    stack = [(root, 0, data)]
+    while stack:
+        parent, key, value = stack.pop()
+        if isinstance(value, dict):
+            if clean:
+                items = [
+                    (k.lower(), v) for k, v in value.items()
+                    # Keep keys if not non-deterministic OR if value is not empty/None
+                    if k.lower() not in NON_DETERMINISTIC_FIELDS and v is not None and v != ""
+                ]
+            else:
+                items = list(value.items())
+            # Stable sort: for keys colliding after lowercasing the last one wins.
+            items.sort(key=itemgetter(0))
+            node = dict(items)
+            children = node.items()
+        else:
+            node = list(value)
+            children = enumerate(value)
+        for k, v in children:
+            if isinstance(v, (dict, list)):
+                stack.append((node, k, v))
+            elif clean and isinstance(v, str) and is_uuid(v):
+                node[k] = v.lower()
+        parent[key] = node
+    return root[0]
+
+def _clean_flat(config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Single-pass ``_rebuild_sorted(config, clean=True)`` for dicts without nested containers.
+
+    The result keeps insertion order rather than sorted keys. Returns None as
+    soon as a dict/list value shows up, leaving it to the general walker.
+    """
+    node = {}
+    for k, v in zip(map(str.lower, config), config.values()):
+        if k in NON_DETERMINISTIC_FIELDS or v is None or v == "":
+            continue
+        if isinstance(v, (dict, list)):
+            return None
+        # For keys colliding after lowercasing the last one wins.
+        node[k] = v.lower() if isinstance(v, str) and is_uuid(v) else v
+    return node
+
 def sort_dict_keys(data: Any) -> Any:
-    if isinstance(data, dict):
-        return {k: sort_dict_keys(data[k]) for k in sorted(data.keys())}
-    elif isinstance(data, list):
-        return [sort_dict_keys(item) for item in data]
-    else:
-        return data
+    return _rebuild_sorted(data, clean=False)
+
+def _clean_with_defaults(config: Dict[str, Any], defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """Cleans a config and fills in its protocol defaults; top-level keys are left unsorted."""
+    # Parsed proxy links are flat, so the recursive walker is rarely needed.
+    node = _clean_flat(config)
+    if node is None:
+        node = _rebuild_sorted(config, clean=True)
+    protocol = node.get('protocol')
+    template = defaults.get(protocol) if protocol else None
+    # One C-level key-set comparison decides whether any default is missing;
+    # if so a single merge applies them all, with the config's values winning.
+    if template and not node.keys() >= template.keys():
+        return {**template, **node}
+    return node
 
 def normalize_config(config: Dict[str, Any], defaults: Dict[str, Any]) -> Dict[str, Any]:
     """Normalizes a configuration dictionary fully."""
-    def recursive_remove_and_lowercase(data: Any) -> Any:
-        if isinstance(data, dict):
-            return {
-                k.lower(): recursive_remove_and_lowercase(v)
-                for k, v in data.items()
-                # Keep keys if not non-deterministic OR if value is not empty/None
-                if k.lower() not in NON_DETERMINISTIC_FIELDS and v is not None and v != ""
-            }
-        elif isinstance(data, list):
-            return [recursive_remove_and_lowercase(item) for item in data]
-        elif isinstance(data, str):
-            # Only lowercase UUIDs if they are actual UUIDs
-            try:
-                import uuid
-                uuid.UUID(data)
-                return data.lower()
-            except ValueError:
-                return data
-        else:
-            return data
-
-    normalized = recursive_remove_and_lowercase(config)
-    protocol = normalized.get('protocol')
-    if protocol and protocol in defaults:
-        for key, value in defaults[protocol].items():
-            normalized.setdefault(key, value)
-    return sort_dict_keys(normalized)
-
+    merged = _clean_with_defaults(config, defaults)
+    return {k: merged[k] for k in sorted(merged)}
+
+
+# Identity fields per protocol, mirroring what makes two links the same server.
+BASE_IDENTITY_KEYS = ('server', 'port')
+UUID_IDENTITY_KEYS = BASE_IDENTITY_KEYS + ('uuid', 'type', 'security')
+QUIC_IDENTITY_KEYS = BASE_IDENTITY_KEYS + ('password', 'sni')
+IDENTITY_KEYS = {
+    'vless': UUID_IDENTITY_KEYS,
+    'vmess': UUID_IDENTITY_KEYS,
+    'trojan': BASE_IDENTITY_KEYS + ('password', 'sni'),
+    'ss': BASE_IDENTITY_KEYS + ('method', 'password', 'plugin'),
+    'ssr': BASE_IDENTITY_KEYS + ('method', 'password', 'protocol_ssr', 'obfs'), # Use specific key
+    'hy2': QUIC_IDENTITY_KEYS,
+    'tuic': QUIC_IDENTITY_KEYS,
+}
+UUID_PROTOCOLS = frozenset(('vless', 'vmess'))
+QUIC_PROTOCOLS = frozenset(('hy2', 'tuic'))
+# A tuple, not a set: vmess 'net' can be any JSON value, and tuple membership never hashes it.
+HOST_PATH_NETWORKS = ('ws', 'grpc', 'http')
 
 def get_identity_fields(config: Dict[str, Any]) -> Dict[str, Any]:
     """Extracts key fields for fingerprinting, now protocol-specific."""
     protocol = config.get('protocol')
-    identity = {'server': config.get('server'), 'port': config.get('port')}
-
-    if protocol == 'vless' or protocol == 'vmess':
-        identity['uuid'] = config.get('uuid')
-        identity['type'] = config.get('type') # Network type
-        identity['security'] = config.get('security') # TLS or None
-        if config.get('type') in ['ws', 'grpc', 'http']:
-            identity['host'] = config.get('host')
-            identity['path'] = config.get('path')
+    keys = IDENTITY_KEYS.get(protocol, BASE_IDENTITY_KEYS)
+    if protocol in UUID_PROTOCOLS:
+        if config.get('type') in HOST_PATH_NETWORKS:
+            keys += ('host', 'path')
         if config.get('security') == 'tls' or config.get('tls') == 'tls':
-            identity['sni'] = config.get('sni')
-    elif protocol == 'trojan':
-        identity['password'] = config.get('password')
-        identity['sni'] = config.get('sni')
-    elif protocol == 'ss':
-        identity['method'] = config.get('method')
-        identity['password'] = config.get('password')
-        identity['plugin'] = config.get('plugin')
-    elif protocol == 'ssr':
-        identity['method'] = config.get('method')
-        identity['password'] = config.get('password')
-        identity['protocol_ssr'] = config.get('protocol_ssr') # Use specific key
-        identity['obfs'] = config.get('obfs')
-    elif protocol == 'hy2' or protocol == 'tuic':
-        identity['password'] = config.get('password') # or uuid
-        identity['sni'] = config.get('sni')
-        identity['insecure'] = config.get('insecure', config.get('allowinsecure'))
-
-    # Return only keys with actual values for a consistent hash
-    return {k: v for k, v in identity.items() if v is not None}
-
-def fingerprint_config(config: Dict[str, Any]) -> str:
-    identity = get_identity_fields(config)
-    serialized = json.dumps(sort_dict_keys(identity), sort_keys=True, separators=(',', ':'))
-    return sha256(serialized.encode('utf-8')).hexdigest()
+            keys += ('sni',)
+
+    # Keep only keys with actual values for a consistent hash
+    identity = {k: config[k] for k in keys if config.get(k) is not None}
+    if protocol in QUIC_PROTOCOLS:
+        insecure = config['insecure'] if 'insecure' in config else config.get('allowinsecure')
+        if insecure is not None:
+            identity['insecure'] = insecure
+    return identity
+
+def freeze_value(value: Any) -> Any:
+    """Converts nested dicts/lists into hashable tuples."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_value(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze_value(item) for item in value)
+    return value
+
+def _identity_key(identity: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+    # Identity keys are unique, so sorting the items never compares values.
+    items = tuple(sorted(identity.items()))
+    try:
+        hash(items)
+    except TypeError: # Rare nested dict/list value (e.g. from defaults)
+        return tuple((k, freeze_value(v)) for k, v in items)
+    return items
+
+def fingerprint_config(config: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+    """Returns the sorted identity items as a hashable dedup key.
+
+    The tuple itself is the key, so equal hashes of different identities
+    (``hash('') == hash(0)``, ``hash(-1) == hash(-2)``) never merge configs.
+    """
+    return _identity_key(get_identity_fields(config))
+
+def normalize_and_fingerprint(config: Dict[str, Any], defaults: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+    """Same result as ``fingerprint_config(normalize_config(config, defaults))``.
+
+    Skips the final key sort, which get_identity_fields does not need.
+    """
+    return fingerprint_config(_clean_with_defaults(config, defaults))
+
+# Schemes whose '#fragment' only feeds the (non-deterministic) remarks; for
+# vmess/ssr, and ss without '@', the fragment is part of the decoded payload.
+REMARK_FRAGMENT_PREFIXES = ('vless://', 'trojan://', 'hy2://', 'tuic://')
+
+def raw_dedup_key(raw_config: str) -> str:
+    """Returns the part of a raw link that determines its parse result."""
+    head, _, _ = raw_config.partition('#')
+    if raw_config.startswith(REMARK_FRAGMENT_PREFIXES) or (raw_config.startswith('ss://') and '@' in head):
+        return head
+    return raw_config
+
+def parsed_dedup_key(config: Dict[str, Any]) -> Optional[frozenset]:
+    """Returns an order-insensitive key of a parsed config without its non-deterministic fields.
+
+    Configs with equal keys normalize to the same dict, so a repeat can skip
+    normalization and fingerprinting. None if a value is unhashable.
+    """
+    try:
+        return frozenset(item for item in config.items() if item[0] not in NON_DETERMINISTIC_FIELDS)
+    except TypeError:
+        return None
+
+def dedupe_content(url: str, content: str, defaults: Dict[str, Any]) -> List[str]:
+    """Decodes one downloaded subscription and returns its unique raw configs in input order."""
+    unique_configs_for_this_url = {}  # identity tuple -> raw_string
+    seen_raw = set()
+    seen_parsed = set()
+    skipped = 0
+    log_skipped = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    for raw_config in decode_content(content):
+        # Repeated lines cannot add a new identity, so skip them before parsing.
+        # Verbatim repeats are caught before even computing the fragment-less key.
+        if raw_config in seen_raw:
+            continue
+        seen_raw.add(raw_config)
+        raw_key = raw_dedup_key(raw_config)
+        if raw_key != raw_config:
+            if raw_key in seen_raw:
+                continue
+            seen_raw.add(raw_key)
+
+        parsed = parse_proxy_link(raw_config)
+        if parsed:
+            # Catches links that differ only in remarks inside the payload (vmess 'ps').
+            parsed_key = parsed_dedup_key(parsed)
+            if parsed_key is not None:
+                if parsed_key in seen_parsed:
+                    continue
+                seen_parsed.add(parsed_key)
+            fingerprint = normalize_and_fingerprint(parsed, defaults)
+            if fingerprint not in unique_configs_for_this_url:
+                unique_configs_for_this_url[fingerprint] = raw_config
+        else:
+            # parse_proxy_link already warned with the reason; keep this per-line echo at DEBUG.
+            skipped += 1
+            if log_skipped:
+                logging.debug("  Skipping unparsable config: %s...", raw_config[:60])
+
+    if not seen_raw: # decode_content yielded nothing
+        logging.warning("No configs found or decoded for URL %s.", url)
+        return []
+    if skipped:
+        logging.warning("  Skipped %s unparsable configs for URL %s.", skipped, url)
+
+    if not unique_configs_for_this_url:
+        logging.warning("No parsable/unique configs found for URL %s.", url)
+    return list(unique_configs_for_this_url.values())
+
+def dedupe_in_worker(url: str, content: str, defaults: Dict[str, Any]) -> Tuple[List[str], List[logging.LogRecord]]:
+    """Runs dedupe_content in a worker process and collects the records it logged."""
+    unique_configs = dedupe_content(url, content, defaults)
+    records = []
+    while not WORKER_LOG_QUEUE.empty():
+        records.append(WORKER_LOG_QUEUE.get_nowait())
+    return unique_configs, records
+
+def dedupe_in_order(downloads: Iterable[Tuple[str, Optional[str]]], defaults: Dict[str, Any], jobs: int) -> Iterator[Tuple[str, Optional[List[str]]]]:
+    """Yields ``(url, unique_configs)`` in input order; ``None`` marks a failed download.
+
+    With ``jobs > 1`` each URL is deduplicated in a worker process, with at
+    most ``2 * jobs`` URLs queued. Workers send their log records back with the
+    result, and they are logged after that URL's "Processing URL" header, so
+    the log reads the same as an in-process run.
+    """
+    if jobs == 1:
+        for url_counter, (url, content) in enumerate(downloads, 1):
+            logging.info("Processing URL %s: %s", url_counter, url)
+            yield url, dedupe_content(url, content, defaults) if content else None
+        return
+
+    def finish(url_counter, url, future):
+        logging.info("Processing URL %s: %s", url_counter, url)
+        if future is None:
+            return url, None
+        unique_configs, records = future.result()
+        root = logging.getLogger()
+        for record in records:
+            root.handle(record)
+        return url, unique_configs
+
+    # Spawned workers: forking here would copy a process that already runs
+    # the download threads and the log listener thread.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=configure_worker_logging) as pool:
+        pending = deque()
+        for url_counter, (url, content) in enumerate(downloads, 1):
+            future = pool.submit(dedupe_in_worker, url, content, defaults) if content else None
+            pending.append((url_counter, url, future))
+            if len(pending) >= 2 * jobs:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
 
 # --- تابع main کامل ---
+def iter_urls(path: str) -> Iterator[str]:
+    """Yields the non-empty, stripped lines of the input file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            url = line.strip()
+            if url:
+                yield url
+
 def main():
+    listener = configure_logging()
+    try:
+        run()
+    finally:
+        listener.stop()
+
+def run():
     parser = argparse.ArgumentParser(description="Download, parse, smartly deduplicate, and save proxy configs as raw strings.")
     parser.add_argument("--input", required=True, help="File with one URL per line.")
     parser.add_argument("--defaults", required=True, help="YAML file with protocol defaults.")
     parser.add_argument("--output-dir", required=True, help="Directory to save individual URL config files (as .txt).")
+    parser.add_argument("--workers", type=int, default=MAX_DOWNLOAD_WORKERS, help=f"Number of concurrent downloads (default: {MAX_DOWNLOAD_WORKERS}).")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes that parse and deduplicate downloaded content (default: 1, in-process).")
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+
     if not os.path.exists(args.input) or os.path.getsize(args.input) == 0:
-        logging.error(f"Input file not found or empty: {args.input}")
+        logging.error("Input file not found or empty: %s", args.input)
         sys.exit(1)
 
     os.makedirs(args.output_dir, exist_ok=True)
     defaults = load_defaults(args.defaults)
     url_counter = 0
-
-    with open(args.input, 'r', encoding='utf-8') as f:
-        urls = [line.strip() for line in f if line.strip()]
-
-    for url in urls:
-        url_counter += 1
-        logging.info(f"Processing URL {url_counter}: {url}")
-        content = download_url(url)
-        if not content:
-            logging.error(f"Skipping URL {url} due to download failure.")
+    if args.workers != MAX_DOWNLOAD_WORKERS:
+        mount_pooled_adapters(SESSION, args.workers)
+
+    # Downloads (and, with --jobs > 1, parsing) run concurrently but results are
+    # yielded in input order, so output naming stays deterministic.
+    downloads = download_in_order(iter_urls(args.input), args.workers)
+    results = dedupe_in_order(downloads, defaults, args.jobs)
+    for url_counter, (url, unique_configs) in enumerate(results, 1):
+        if unique_configs is None:
+            logging.error("Skipping URL %s due to download failure.", url)
             continue
-
-        raw_configs = decode_content(content)
-        if not raw_configs:
-            logging.warning(f"No configs found or decoded for URL {url}.")
-            continue
-
-        unique_configs_for_this_url = {}  # fingerprint -> raw_string
-
-        for raw_config in raw_configs:
-            parsed = parse_proxy_link(raw_config)
-            if parsed:
-                normalized = normalize_config(parsed, defaults)
-                fingerprint = fingerprint_config(normalized)
-                if fingerprint not in unique_configs_for_this_url:
-                    unique_configs_for_this_url[fingerprint] = raw_config
-            else:
-                logging.warning(f"  Skipping unparsable config: {raw_config[:60]}...")
-
-        final_configs_for_url_file = list(unique_configs_for_this_url.values())
-
-        if not final_configs_for_url_file:
-            logging.warning(f"No parsable/unique configs found for URL {url}.")
+        if not unique_configs:
             continue
 
         try:
-            parsed_url = urlparse(url)
+            parsed_url = urlsplit(url)
             output_filename = os.path.basename(parsed_url.path)
             if not output_filename or output_filename == '/':
                 output_filename = f"{url_counter:04d}.txt"
-                logging.warning(f"  URL has no filename, using {output_filename}.")
+                logging.warning("  URL has no filename, using %s.", output_filename)
 
             output_filepath = os.path.join(args.output_dir, output_filename)
 
             if os.path.exists(output_filepath):
-                logging.warning(f"  File {output_filename} already exists! It will be OVERWRITTEN by URL: {url}")
+                logging.warning("  File %s already exists! It will be OVERWRITTEN by URL: %s", output_filename, url)
 
             with open(output_filepath, 'w', encoding='utf-8') as f_ind:
-                for conf in final_configs_for_url_file:
-                    f_ind.write(conf + '\n')
-            logging.info(f"  Saved {len(final_configs_for_url_file)} unique configs from {url} to {output_filepath}")
+                # One pre-joined buffer: a single encode pass and write call per file.
+                f_ind.write('\n'.join(unique_configs))
+                f_ind.write('\n')
+            logging.info("  Saved %s unique configs from %s to %s", len(unique_configs), url, output_filepath)
         except Exception as e:
-            logging.error(f"  Failed to determine filename or save file for {url}: {e}")
+            logging.error("  Failed to determine filename or save file for %s: %s", url, e)
 
-    logging.info(f"Processed {url_counter} URLs. Output saved in {args.output_dir}")
+    logging.info("Processed %s URLs. Output saved in %s", url_counter, args.output_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,12 +1,35 @@
+import base64
 import json
 import unittest
 from unittest.mock import patch, mock_open
+from urllib.parse import parse_qs, urlsplit
+
+from urllib3.response import HTTPResponse
+
 from scripts.deduplicate import (
     normalize_config,
     fingerprint_config,
-    detect_protocol,
+    fast_split,
+    parse_proxy_link,
+    get_identity_fields,
+    dedupe_content,
+    DOWNLOAD_RETRY,
+    dedupe_in_order,
+    raw_dedup_key,
+    safe_b64decode,
+    decode_content,
+    parse_query,
+    parsed_dedup_key,
+    normalize_and_fingerprint,
 )
 
+UUID = 'B831381D-6324-4D53-AD4F-8CDA48B30811'
+
+def vmess_link(**fields):
+    payload = {'v': '2', 'add': '1.2.3.4', 'port': '443', 'id': UUID, 'net': 'ws', 'host': 'h.example.com', 'path': '/p'}
+    payload.update(fields)
+    return 'vmess://' + base64.b64encode(json.dumps(payload).encode()).decode()
+
 class TestDeduplication(unittest.TestCase):
 
     def setUp(self):
@@ -21,34 +44,257 @@ class TestDeduplication(unittest.TestCase):
             'server_port': 443,
             'password': 'pass',
             'timestamp': '12345',
-            'UUID': 'aBcDeF'
+            'UUID': UUID
         }
         expected = {
+            'password': 'pass',
             'server': '1.1.1.1',
             'server_port': 443,
-            'password': 'pass',
-            'UUID': 'abcdef'
+            'uuid': UUID.lower()
         }
         self.assertEqual(normalize_config(config, self.defaults), expected)
 
     def test_detect_protocol(self):
-        ss_config = {'server': '1.1.1.1', 'server_port': 80, 'password': 'p', 'method': 'm'}
-        trojan_config = {'server': '1.1.1.1', 'server_port': 443, 'password': 'p', 'sni': 's'}
-        self.assertEqual(detect_protocol(ss_config), 'shadowsocks')
-        self.assertEqual(detect_protocol(trojan_config), 'trojan')
+        ss_config = parse_proxy_link('ss://bTpw@1.1.1.1:80')
+        trojan_config = parse_proxy_link('trojan://p@1.1.1.1:443?sni=s')
+        self.assertEqual(ss_config['protocol'], 'ss')
+        self.assertEqual(trojan_config['protocol'], 'trojan')
 
     def test_fingerprint_config(self):
-        config1 = {'server': '1.1.1.1', 'server_port': 80, 'password': 'p', 'method': 'm'}
-        config2 = {'server': '1.1.1.1', 'server_port': 80, 'password': 'p', 'method': 'm', 'comment': 'c'}
-        config3 = {'server': '2.2.2.2', 'server_port': 80, 'password': 'p', 'method': 'm'}
+        config1 = {'protocol': 'ss', 'server': '1.1.1.1', 'port': 80, 'password': 'p', 'method': 'm'}
+        config2 = {'protocol': 'ss', 'server': '1.1.1.1', 'port': 80, 'password': 'p', 'method': 'm', 'comment': 'c'}
+        config3 = {'protocol': 'ss', 'server': '2.2.2.2', 'port': 80, 'password': 'p', 'method': 'm'}
 
-        with patch('scripts.deduplicate.detect_protocol', return_value='shadowsocks'):
-            fp1 = fingerprint_config(config1)
-            fp2 = fingerprint_config(config2)
-            fp3 = fingerprint_config(config3)
+        fp1 = fingerprint_config(config1)
+        fp2 = fingerprint_config(config2)
+        fp3 = fingerprint_config(config3)
 
         self.assertEqual(fp1, fp2)
         self.assertNotEqual(fp1, fp3)
 
+
+class TestFastSplit(unittest.TestCase):
+
+    def test_matches_urlsplit(self):
+        links = [
+            'vless://uuid@Example.com:443?type=ws&path=%2Fws#remark',
+            'trojan://pw@h.example.com:8443',
+            'hy2://pw@1.2.3.4:443/?sni=a.example.com#r%20x',
+            'ss://YWVzLTI1Ni1nY206cGFzcw==@1.2.3.4:8388#rem',
+            'VLESS://u@h:1/p/q?a=1?b=2#f#g',
+            'tuic://u:p@h',
+        ]
+        for link in links:
+            with self.subTest(link=link):
+                fast, slow = fast_split(link), urlsplit(link)
+                self.assertEqual(fast, slow)
+                self.assertEqual((fast.username, fast.hostname, fast.port), (slow.username, slow.hostname, slow.port))
+
+    def test_bad_port_raises_like_urlsplit(self):
+        with self.assertRaises(ValueError):
+            fast_split('trojan://pw@h:notaport').port
+
+    def test_defers_to_urlsplit(self):
+        for link in ('vless://u@[::1]:443', 'trojan://pw@hôst:443', 'vless://u@h:1\t', 'not a link', '1ss://h'):
+            with self.subTest(link=link):
+                self.assertIsNone(fast_split(link))
+
+
+class TestFingerprintKeys(unittest.TestCase):
+
+    def test_hash_collisions_stay_distinct(self):
+        pairs = [
+            ({'protocol': 'trojan', 'server': 'h', 'port': 443, 'password': 'p', 'sni': ''},
+             {'protocol': 'trojan', 'server': 'h', 'port': 443, 'password': 'p', 'sni': 0}),
+            ({'protocol': 'ss', 'server': 'h', 'port': -1}, {'protocol': 'ss', 'server': 'h', 'port': -2}),
+        ]
+        for a, b in pairs:
+            with self.subTest(a=a, b=b):
+                fp_a, fp_b = fingerprint_config(a), fingerprint_config(b)
+                self.assertEqual(hash(fp_a), hash(fp_b))
+                self.assertNotEqual(fp_a, fp_b)
+                self.assertEqual(len({fp_a: a, fp_b: b}), 2)
+
+    def test_unhashable_values_are_frozen(self):
+        fp = fingerprint_config({'protocol': 'ss', 'server': 'h', 'port': 1, 'plugin': {'name': ['obfs']}})
+        self.assertEqual(dict(fp)['plugin'], (('name', ('obfs',)),))
+
+    def test_normalize_and_fingerprint_matches_two_step(self):
+        defaults = {'vless': {'type': 'ws', 'path': '/'}}
+        configs = [
+            {'protocol': 'vless', 'server': 'h', 'port': 443, 'uuid': UUID.upper()},
+            {'protocol': 'vless', 'server': 'h', 'port': 443, 'uuid': UUID, 'type': 'grpc', 'path': '/g'},
+            {'Protocol': 'VLESS', 'protocol': 'vless', 'server': 'h', 'port': 443, 'extra': {'B': [UUID.upper()]}},
+            {'protocol': 'ss', 'server': 'h', 'port': 1, 'password': None},
+        ]
+        for config in configs:
+            with self.subTest(config=config):
+                self.assertEqual(normalize_and_fingerprint(config, defaults),
+                                 fingerprint_config(normalize_config(config, defaults)))
+
+
+class TestIdentityFields(unittest.TestCase):
+
+    def test_host_path_only_for_host_path_networks(self):
+        base = {'protocol': 'vmess', 'server': 'h', 'port': 443, 'uuid': 'u', 'host': 'a', 'path': '/p'}
+        self.assertIn('path', get_identity_fields(dict(base, type='ws')))
+        self.assertNotIn('path', get_identity_fields(dict(base, type='tcp')))
+
+    def test_unhashable_network_does_not_raise(self):
+        for net in (['ws'], {'name': 'ws'}):
+            with self.subTest(net=net):
+                identity = get_identity_fields({'protocol': 'vmess', 'server': 'h', 'port': 443, 'type': net, 'path': '/p'})
+                self.assertNotIn('path', identity)
+
+    def test_vmess_with_unhashable_net_is_kept(self):
+        links = [vmess_link(net=['ws']), vmess_link(net={'name': 'ws'}), vmess_link(net='ws')]
+        self.assertEqual(dedupe_content('u', '\n'.join(links), {}), links)
+
+
+class TestDownloadRetry(unittest.TestCase):
+
+    def test_ignores_retry_after(self):
+        response = HTTPResponse(status=503, headers={'Retry-After': '3600'})
+        with patch('time.sleep') as sleep:
+            DOWNLOAD_RETRY.sleep(response)
+        self.assertTrue(all(c.args[0] < 60 for c in sleep.call_args_list))
+
+
+class TestDedupeInOrder(unittest.TestCase):
+
+    def test_jobs_match_in_process_run(self):
+        downloads = [
+            ('http://h/a.txt', '\n'.join([vmess_link(ps='a'), vmess_link(ps='b'), 'garbage', 'trojan://p@h:443#x'])),
+            ('http://h/b.txt', None),
+            ('http://h/c.txt', base64.b64encode(b'trojan://p@h:443#x\ntrojan://p@h:443#y\nss://bad').decode()),
+            ('http://h/d.txt', 'unknown://x'),
+        ]
+        runs = []
+        for jobs in (1, 2):
+            with self.assertLogs(level='INFO') as logs:
+                results = list(dedupe_in_order(iter(downloads), {}, jobs))
+            runs.append((results, logs.output))
+        self.assertEqual(runs[0], runs[1])
+        self.assertEqual(runs[0][1][0], 'INFO:root:Processing URL 1: http://h/a.txt')
+
+
+class TestRawDedupKey(unittest.TestCase):
+
+    def test_drops_remark_fragment(self):
+        self.assertEqual(raw_dedup_key('vless://u@h:443?type=ws#a'), 'vless://u@h:443?type=ws')
+        self.assertEqual(raw_dedup_key('trojan://pw@h:443#x#y'), 'trojan://pw@h:443')
+        self.assertEqual(raw_dedup_key('ss://bWV0aG9kOnB3@h:1#r'), 'ss://bWV0aG9kOnB3@h:1')
+
+    def test_keeps_payload_fragments(self):
+        for link in ('vmess://eyJhIjoxfQ==#r', 'ssr://aDoxOm86bTpvOmNB#r', 'ss://bWV0aG9kOnB3QGg6MQ==#r'):
+            with self.subTest(link=link):
+                self.assertEqual(raw_dedup_key(link), link)
+
+    def test_remark_only_repeats_are_skipped(self):
+        links = ['trojan://p@h:443#a', 'trojan://p@h:443#b', 'trojan://p@h:443#a', 'trojan://p@h2:443#a']
+        self.assertEqual(dedupe_content('u', '\n'.join(links), {}), [links[0], links[3]])
+
+
+class TestShadowsocksLinks(unittest.TestCase):
+
+    def test_plain_and_base64_user_info(self):
+        for link in ('ss://aes-256-gcm:pass@1.2.3.4:8388#r', 'ss://YWVzLTI1Ni1nY206cGFzcw==@1.2.3.4:8388#r'):
+            with self.subTest(link=link):
+                config = parse_proxy_link(link)
+                self.assertEqual((config['method'], config['password'], config['port']), ('aes-256-gcm', 'pass', 8388))
+
+    def test_legacy_link_without_at(self):
+        link = 'ss://YWVzLTI1Ni1nY206cGFzc0AxLjIuMy40OjgzODg=#rem'
+        config = parse_proxy_link(link)
+        self.assertEqual((config['method'], config['password']), ('aes-256-gcm', 'pass@1.2.3.4:8388'))
+        self.assertEqual(dedupe_content('u', link, {}), [link])
+
+
+class TestSafeB64decode(unittest.TestCase):
+
+    def test_missing_padding_and_urlsafe_alphabet(self):
+        self.assertEqual(safe_b64decode('YQ'), b'a')
+        self.assertEqual(safe_b64decode('-_-_'), base64.b64decode('+/+/'))
+
+    def test_stops_at_closing_padding(self):
+        self.assertEqual(safe_b64decode('eyJhIjoxfQ==#other%20remark'), b'{"a":1}')
+        self.assertEqual(safe_b64decode('YQ==\nYg=='), b'a')
+        self.assertEqual(safe_b64decode('YWJj\nZGVm\n'), b'abcdef')
+
+    def test_vmess_with_remark_fragment(self):
+        for ps in ('n1', 'n12', 'n123'):  # unpadded, '==' and '=' payloads
+            link = vmess_link(ps=ps)
+            with self.subTest(link=link):
+                self.assertIsNotNone(parse_proxy_link(link))
+                self.assertEqual(parse_proxy_link(link + '#other%20remark'), parse_proxy_link(link))
+
+
+class TestDecodeContent(unittest.TestCase):
+
+    LINKS = ['vless://u@h:443?type=ws#a', 'trojan://p@h:443#b']
+
+    def test_plain_text(self):
+        self.assertEqual(list(decode_content('\n'.join(self.LINKS) + '\n\n')), self.LINKS)
+
+    def test_base64(self):
+        body = base64.b64encode('\n'.join(self.LINKS).encode()).decode()
+        self.assertEqual(list(decode_content(body)), self.LINKS)
+
+    def test_wrapped_base64(self):
+        links = self.LINKS * 5
+        body = base64.encodebytes('\n'.join(links).encode()).decode()  # 76-column lines
+        self.assertIn('\n', body.rstrip())
+        self.assertEqual(list(decode_content(body)), links)
+
+    def test_base64_with_spaces_and_tabs(self):
+        encoded = base64.b64encode('\n'.join(self.LINKS).encode()).decode()
+        body = '  ' + ' '.join(encoded[i:i + 8] for i in range(0, len(encoded), 8)) + '\t\n'
+        self.assertEqual(list(decode_content(body)), self.LINKS)
+
+
+class TestParseQuery(unittest.TestCase):
+
+    def test_matches_parse_qs(self):
+        queries = [
+            '', 'type=ws&security=tls', 'path=%2Fws%3Fed%3D2048&host=a+b',
+            'sni=a&sni=b', 'Type=a&type=b', 'flag&empty=&x=1', '&&a=1&', 'k=v=w',
+        ]
+        for query in queries:
+            with self.subTest(query=query):
+                expected = {k.lower(): v[0] for k, v in parse_qs(query).items()}
+                self.assertEqual(parse_query(query), expected)
+
+    def test_cached_result_is_shared(self):
+        self.assertIs(parse_query('type=ws&sni=a'), parse_query('type=ws&sni=a'))
+
+
+class TestParsedDedupKey(unittest.TestCase):
+
+    def dedupe_parsed(self, parsed_configs):
+        """Runs dedupe_content over stand-in lines that parse to the given dicts."""
+        lines = ['line%d' % i for i in range(len(parsed_configs))]
+        parsed = dict(zip(lines, parsed_configs))
+        with patch('scripts.deduplicate.parse_proxy_link', side_effect=parsed.get), \
+                patch('scripts.deduplicate.normalize_and_fingerprint', wraps=normalize_and_fingerprint) as fingerprint:
+            kept = dedupe_content('u', '\n'.join(lines), {})
+        return [lines.index(line) for line in kept], fingerprint.call_count
+
+    def test_vmess_remark_only_repeat_skips_fingerprinting(self):
+        links = [vmess_link(ps='a'), vmess_link(ps='b')]
+        configs = [parse_proxy_link(link) for link in links]
+        self.assertEqual(self.dedupe_parsed(configs), ([0], 1))
+        self.assertEqual(dedupe_content('u', '\n'.join(links), {}), links[:1])
+
+    def test_unhashable_value_falls_back_to_fingerprint(self):
+        config = parse_proxy_link(vmess_link(net=['ws']))
+        self.assertIsNone(parsed_dedup_key(config))
+        self.assertEqual(self.dedupe_parsed([dict(config, remarks='a'), dict(config, remarks='b')]), ([0], 2))
+
+    def test_key_case_difference_is_not_skipped(self):
+        a = {'protocol': 'vless', 'server': 'h', 'port': 443, 'uuid': UUID, 'type': 'ws', 'path': '/a'}
+        b = {'protocol': 'vless', 'server': 'h', 'port': 443, 'uuid': UUID, 'type': 'ws', 'Path': '/b'}
+        self.assertNotEqual(parsed_dedup_key(a), parsed_dedup_key(b))
+        self.assertEqual(self.dedupe_parsed([a, b]), ([0, 1], 2))
+
 if __name__ == '__main__':
     unittest.main()